@@ -2,16 +2,21 @@
 data reader for LUDB
 """
 import os
+import sys
 import json
+import logging
 from collections import namedtuple
 from datetime import datetime
+from functools import lru_cache
+from math import gcd
+from types import MappingProxyType
 from typing import Union, Optional, Any, List, Tuple, Dict, Sequence, NoReturn
 from numbers import Real
 
 import numpy as np
 np.set_printoptions(precision=5, suppress=True)
-import pandas as pd
 import wfdb
+from scipy.signal import resample_poly, firwin
 from easydict import EasyDict as ED
 
 import utils
@@ -30,6 +35,80 @@ __all__ = [
 ]
 
 
+# waves of each lead are stored column-wise in structured arrays,
+# with the names of the waves encoded by `_NAME_IDS`
+_WAVE_DTYPE = np.dtype([
+    ('onset', 'i4'), ('offset', 'i4'), ('peak', 'i4'), ('duration', 'f4'), ('name_id', 'u1'),
+])
+_NAME_IDS = {'pwave': 0, 'qrs': 1, 'twave': 2}
+_ID_NAMES = {v:k for k,v in _NAME_IDS.items()}
+
+
+# wfdb re-parses the header and re-decodes the signal files on every call,
+# hence the readings are cached, keyed by the full path of the record
+@lru_cache(maxsize=256)
+def _load_header_cached(rec_fp:str) -> MappingProxyType:
+    """
+    load header data of the record into a read-only mapping,
+    list-valued items are stored as tuples, as the mapping is shared between calls
+    """
+    header_dict = {}
+    header_reader = wfdb.rdheader(rec_fp)
+    header_dict['units'] = tuple(header_reader.units)
+    header_dict['baseline'] = tuple(header_reader.baseline)
+    header_dict['adc_gain'] = tuple(header_reader.adc_gain)
+    header_dict['record_fmt'] = tuple(header_reader.fmt)
+    try:
+        header_dict['age'] = int([l for l in header_reader.comments if '<age>' in l][0].split(': ')[-1])
+    except:
+        header_dict['age'] = np.nan
+    try:
+        header_dict['sex'] = [l for l in header_reader.comments if '<sex>' in l][0].split(': ')[-1]
+    except:
+        header_dict['sex'] = ''
+    d_start = [idx for idx, l in enumerate(header_reader.comments) if '<diagnoses>' in l][0] + 1
+    header_dict['diagnoses'] = tuple(header_reader.comments[d_start:])
+    return MappingProxyType(header_dict)
+
+
+@lru_cache(maxsize=1024)
+def _rdann_cached(rec_fp:str, extension:str) -> wfdb.Annotation:
+    """
+    cached version of `wfdb.rdann`
+    """
+    return wfdb.rdann(rec_fp, extension=extension)
+
+
+@lru_cache(maxsize=64)
+def _load_raw(rec_fp:str, leads:Tuple[str, ...]) -> np.ndarray:
+    """
+    load the physical signal of the record in 'channel_first' format, with units in mV;
+    the returned array is shared between calls, hence is set read-only
+    """
+    wfdb_rec = wfdb.rdrecord(rec_fp, physical=True, channel_names=list(leads))
+    # p_signal of 'lead_last' format
+    # ref. ISSUES 1.
+    # float32 is lossless for ecg signals (originally 16-bit), and halves the memory
+    data = wfdb_rec.p_signal.T.astype(np.float32, copy=False) * np.float32(1e-3)
+    data.flags.writeable = False
+    return data
+
+
+@lru_cache(maxsize=16)
+def _resample_filter(up:int, down:int) -> np.ndarray:
+    """
+    the low-pass FIR filter designed by `resample_poly` (with its default kaiser window) for the rates `up`/`down`,
+    cached to avoid re-designing it on every call, and passed to `resample_poly` as its `window`;
+    in float32 (as the signals are), otherwise `upfirdn` would promote the convolution to float64
+    """
+    g = gcd(up, down)
+    max_rate = max(up, down) // g
+    half_len = 10 * max_rate
+    h = firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0)).astype(np.float32)
+    h.flags.writeable = False
+    return h
+
+
 class LUDBReader(object):
     """ NOT Finished, 
 
@@ -179,6 +258,7 @@ class LUDBReader(object):
         self.data_ext = "dat"
         self.all_leads = ['I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6',]
         self.all_leads_lower = [l.lower() for l in self.all_leads]
+        self._lead_idx = {l:idx for idx, l in enumerate(self.all_leads_lower)}
         self.beat_ann_ext = [f"atr_{item}" for item in self.all_leads_lower]
 
         self._all_symbols = ['(', ')', 'p', 'N', 't']
@@ -296,22 +376,22 @@ class LUDBReader(object):
         Returns:
         --------
         data: ndarray,
-            the ecg data
+            the ecg data, of dtype float32
         """
         assert data_format.lower() in ['channel_first', 'lead_first', 'channel_last', 'lead_last']
         _leads = self._normalize_leads(leads, standard_ordering=True, lower_cases=True)
         
         rec_fp = os.path.join(self.db_dir, rec)
-        wfdb_rec = wfdb.rdrecord(rec_fp, physical=True, channel_names=_leads)
-        # p_signal of 'lead_last' format
-        # ref. ISSUES 1.
-        data = np.asarray(wfdb_rec.p_signal.T / 1000)
+        data = _load_raw(rec_fp, tuple(_leads)).copy()
 
         if units.lower() in ['uv', 'μv']:
-            data = data * 1000
+            data *= np.float32(1000)
 
         if freq is not None and freq != self.freq:
-            data = resample_poly(data, freq, self.freq, axis=1)
+            up, down = int(freq), int(self.freq)
+            data = resample_poly(
+                data, up, down, axis=1, window=_resample_filter(up, down),
+            ).astype(np.float32, copy=False)
 
         if data_format.lower() in ['channel_last', 'lead_last']:
             data = data.T
@@ -336,6 +416,8 @@ class LUDBReader(object):
         Returns:
         --------
         ann_dict: dict,
+            with item 'waves' a dict, each item value is a structured ndarray (of dtype `_WAVE_DTYPE`)
+            of the waves of the lead, which can be converted into a list of `ECGWaveForm`s via `self.as_waveforms`
         """
         ann_dict = ED()
         rec_fp = os.path.join(self.db_dir, rec)
@@ -343,57 +425,40 @@ class LUDBReader(object):
         # wave delineation annotations
         _leads = self._normalize_leads(leads, standard_ordering=True, lower_cases=False)
         _ann_ext = [f"atr_{l.lower()}" for l in _leads]
-        ann_dict['waves'] = ED({l:[] for l in _leads})
-        for l, e in zip(_leads, _ann_ext):
-            ann = wfdb.rdann(rec_fp, extension=e)
-            df_lead_ann = pd.DataFrame()
-            symbols = np.array(ann.symbol)
-            peak_inds = np.where(np.isin(symbols, ['p', 'N', 't']))[0]
-            df_lead_ann['peak'] = ann.sample[peak_inds]
-            df_lead_ann['onset'] = np.nan
-            df_lead_ann['offset'] = np.nan
-            for i, row in df_lead_ann.iterrows():
-                peak_idx = peak_inds[i]
-                if peak_idx == 0:
-                    df_lead_ann.loc[i, 'onset'] = row['peak']
-                    if symbols[peak_idx+1] == ')':
-                        df_lead_ann.loc[i, 'offset'] = ann.sample[peak_idx+1]
-                    else:
-                        df_lead_ann.loc[i, 'offset'] = row['peak']
-                elif peak_idx == len(symbols) - 1:
-                    df_lead_ann.loc[i, 'offset'] = row['peak']
-                    if symbols[peak_idx-1] == '(':
-                        df_lead_ann.loc[i, 'onset'] = ann.sample[peak_idx-1]
-                    else:
-                        df_lead_ann.loc[i, 'onset'] = row['peak']
-                else:
-                    if symbols[peak_idx-1] == '(':
-                        df_lead_ann.loc[i, 'onset'] = ann.sample[peak_idx-1]
-                    else:
-                        df_lead_ann.loc[i, 'onset'] = row['peak']
-                    if symbols[peak_idx+1] == ')':
-                        df_lead_ann.loc[i, 'offset'] = ann.sample[peak_idx+1]
-                    else:
-                        df_lead_ann.loc[i, 'offset'] = row['peak']
-            # df_lead_ann['onset'] = ann.sample[np.where(symbols=='(')[0]]
-            # df_lead_ann['offset'] = ann.sample[np.where(symbols==')')[0]]
-
-            df_lead_ann['duration'] = (df_lead_ann['offset'] - df_lead_ann['onset']) * self.spacing
-            
-            df_lead_ann.index = symbols[peak_inds]
-
-            for c in ['peak', 'onset', 'offset']:
-                df_lead_ann[c] = df_lead_ann[c].values.astype(int)
-            
-            for _, row in df_lead_ann.iterrows():
-                w = ECGWaveForm(
-                    name=self._symbol_to_wavename[row.name],
-                    onset=int(row.onset),
-                    offset=int(row.offset),
-                    peak=int(row.peak),
-                    duration=row.duration,
-                )
-                ann_dict['waves'][l].append(w)
+        ann_dict['waves'] = ED()
+        anns = [_rdann_cached(rec_fp, e) for e in _ann_ext]
+        # annotations of all the leads are concatenated and processed at once,
+        # with `lead_ids` recording the lead (index in `_leads`) of each annotation
+        samples = np.concatenate([ann.sample for ann in anns])
+        symbols = np.array([sym for ann in anns for sym in ann.symbol])
+        lead_ids = np.repeat(np.arange(len(anns)), [len(ann.symbol) for ann in anns])
+        peak_inds = np.where(np.isin(symbols, ['p', 'N', 't']))[0]
+        peaks = samples[peak_inds]
+        # onset (resp. offset) is the preceding '(' (resp. following ')') of the same lead,
+        # and falls back to the peak if absent
+        onset = peaks.copy()
+        offset = peaks.copy()
+        not_first = peak_inds > 0
+        not_first[not_first] = lead_ids[peak_inds[not_first]-1] == lead_ids[peak_inds[not_first]]
+        not_last = peak_inds < len(symbols) - 1
+        not_last[not_last] = lead_ids[peak_inds[not_last]+1] == lead_ids[peak_inds[not_last]]
+        prev_open = np.zeros_like(peak_inds, dtype=bool)
+        prev_open[not_first] = symbols[peak_inds[not_first]-1] == '('
+        next_close = np.zeros_like(peak_inds, dtype=bool)
+        next_close[not_last] = symbols[peak_inds[not_last]+1] == ')'
+        onset[prev_open] = samples[peak_inds[prev_open]-1]
+        offset[next_close] = samples[peak_inds[next_close]+1]
+
+        waves_arr = np.empty(len(peak_inds), dtype=_WAVE_DTYPE)
+        waves_arr['onset'] = onset
+        waves_arr['offset'] = offset
+        waves_arr['peak'] = peaks
+        waves_arr['duration'] = (offset - onset) * self.spacing
+        waves_arr['name_id'] = [_NAME_IDS[self._symbol_to_wavename[sym]] for sym in symbols[peak_inds]]
+        # `lead_ids` is non-decreasing, hence the waves of each lead are contiguous
+        split_inds = np.searchsorted(lead_ids[peak_inds], np.arange(1, len(_leads)))
+        for l, l_w in zip(_leads, np.split(waves_arr, split_inds)):
+            ann_dict['waves'][l] = l_w
 
         if metadata:
             header_dict = self._load_header(rec)
@@ -402,6 +467,30 @@ class LUDBReader(object):
         return ann_dict
 
 
+    def as_waveforms(self, waves:np.ndarray) -> List[ECGWaveForm]:
+        """ finished, checked,
+
+        convert the waves (of one lead) loaded by `self.load_ann` into a list of `ECGWaveForm`s
+
+        Parameters:
+        -----------
+        waves: ndarray,
+            structured array of dtype `_WAVE_DTYPE`
+
+        Returns:
+        --------
+        waveforms: list of `ECGWaveForm`,
+        """
+        waveforms = [
+            ECGWaveForm(name=_ID_NAMES[i], onset=o, offset=f, peak=p, duration=d)
+            for i, o, f, p, d in zip(
+                waves['name_id'].tolist(), waves['onset'].tolist(), waves['offset'].tolist(),
+                waves['peak'].tolist(), waves['duration'].tolist(),
+            )
+        ]
+        return waveforms
+
+
     def load_diagnoses(self, rec:str) -> List[str]:
         """ finished, checked,
 
@@ -416,7 +505,7 @@ class LUDBReader(object):
         --------
         diagnoses: list of str,
         """
-        diagnoses = self._load_header(rec)['diagnoses']
+        diagnoses = list(self._load_header(rec)['diagnoses'])
         return diagnoses
 
 
@@ -449,9 +538,10 @@ class LUDBReader(object):
         data = self.load_data(rec, leads=_leads, data_format='channel_first')
         masks = np.full_like(data, fill_value=_class_map.i, dtype=int)
         waves = self.load_ann(rec, leads=_leads, metadata=False)['waves']
+        name_id_to_class = {i: _class_map[self._wavename_to_symbol[n]] for n, i in _NAME_IDS.items()}
         for idx, (l, l_w) in enumerate(waves.items()):
-            for w in l_w:
-                masks[idx, w.onset: w.offset] = _class_map[self._wavename_to_symbol[w.name]]
+            for onset, offset, name_id in zip(l_w['onset'].tolist(), l_w['offset'].tolist(), l_w['name_id'].tolist()):
+                masks[idx, onset: offset] = name_id_to_class[name_id]
         if mask_format.lower() not in ['channel_first', 'lead_first',]:
             masks = masks.T
         return masks
@@ -523,23 +613,9 @@ class LUDBReader(object):
         --------
         header_dict: dict,
         """
-        header_dict = ED({})
         rec_fp = os.path.join(self.db_dir, rec)
-        header_reader = wfdb.rdheader(rec_fp)
-        header_dict['units'] = header_reader.units
-        header_dict['baseline'] = header_reader.baseline
-        header_dict['adc_gain'] = header_reader.adc_gain
-        header_dict['record_fmt'] = header_reader.fmt
-        try:
-            header_dict['age'] = int([l for l in header_reader.comments if '<age>' in l][0].split(': ')[-1])
-        except:
-            header_dict['age'] = np.nan
-        try:
-            header_dict['sex'] = [l for l in header_reader.comments if '<sex>' in l][0].split(': ')[-1]
-        except:
-            header_dict['sex'] = ''
-        d_start = [idx for idx, l in enumerate(header_reader.comments) if '<diagnoses>' in l][0] + 1
-        header_dict['diagnoses'] = header_reader.comments[d_start:]
+        # copy out of the (read-only) cached mapping
+        header_dict = ED(dict(_load_header_cached(rec_fp)))
         return header_dict
 
 
@@ -562,11 +638,12 @@ class LUDBReader(object):
         else:
             _leads = [l.lower() for l in leads]
 
+        _lead_set = set(_leads)
         if standard_ordering:
-            _leads = [l for l in self.all_leads_lower if l in _leads]
+            _leads = [l for l in self.all_leads_lower if l in _lead_set]
         
         if not lower_cases:
-            _lead_indices = [idx for idx, l in enumerate(self.all_leads_lower) if l in _leads]
+            _lead_indices = [idx for idx, l in enumerate(self.all_leads_lower) if l in _lead_set]
             _leads = [self.all_leads[idx] for idx in _lead_indices]
         
         return _leads
@@ -616,7 +693,7 @@ class LUDBReader(object):
 
         # lead_list = self.load_ann(rec)['df_leads']['lead_name'].tolist()
         # _lead_indices = [lead_list.index(l) for l in leads]
-        _lead_indices = [self.all_leads.index(l) for l in _leads]
+        _lead_indices = [self._lead_idx[l.lower()] for l in _leads]
         if data is None:
             _data = self.load_data(rec, data_format='channel_first', units='μV')[_lead_indices]
         else:
@@ -635,19 +712,25 @@ class LUDBReader(object):
         if data is None and waves is None:
             waves = self.load_ann(rec, leads=_leads)['waves']
 
+        # intervals of each group of waves, for each lead
+        wave_groups = {g: {l:[] for l in _leads} for g in ['pwaves', 'qrs', 'twaves']}
+        wavename_to_group = {
+            self._symbol_to_wavename['p']: 'pwaves',
+            self._symbol_to_wavename['N']: 'qrs',
+            self._symbol_to_wavename['t']: 'twaves',
+        }
         if waves is not None:
-            pwaves = {l:[] for l in _leads}
-            qrs = {l:[] for l in _leads}
-            twaves = {l:[] for l in _leads}
             for l, l_w in waves.items():
+                if isinstance(l_w, np.ndarray):
+                    # structured array from `self.load_ann`
+                    itvs = zip(l_w['name_id'].tolist(), l_w['onset'].tolist(), l_w['offset'].tolist())
+                    for name_id, onset, offset in itvs:
+                        wave_groups[wavename_to_group[_ID_NAMES[name_id]]][l].append([onset, offset])
+                    continue
+                # list of `ECGWaveForm`s, e.g. from `self.from_masks`
                 for w in l_w:
-                    itv = [w.onset, w.offset]
-                    if w.name == self._symbol_to_wavename['p']:
-                        pwaves[l].append(itv)
-                    elif w.name == self._symbol_to_wavename['N']:
-                        qrs[l].append(itv)
-                    elif w.name == self._symbol_to_wavename['t']:
-                        twaves[l].append(itv)
+                    if w.name in wavename_to_group:
+                        wave_groups[wavename_to_group[w.name]][l].append([w.onset, w.offset])
         
         palette = {'pwaves': 'green', 'qrs': 'red', 'twaves': 'yellow',}
         plot_alpha = 0.4
@@ -683,11 +766,11 @@ class LUDBReader(object):
             # https://stackoverflow.com/questions/16826711/is-it-possible-to-add-a-string-as-a-legend-item-in-matplotlib
             for d in diagnoses:
                 axes[idx].plot([], [], ' ', label=d)
-            for w in ['pwaves', 'qrs', 'twaves']:
-                for itv in eval(f"{w}['{lead_name}']"):
+            for g, color in palette.items():
+                for itv in wave_groups[g].get(lead_name, []):
                     axes[idx].axvspan(
                         itv[0]/self.freq, itv[1]/self.freq,
-                        color=palette[w], alpha=plot_alpha,
+                        color=color, alpha=plot_alpha,
                     )
             axes[idx].legend(loc='upper left')
             axes[idx].set_xlim(t[0], t[-1])
@@ -715,7 +798,8 @@ class LUDBReader(object):
             units of `data`, 'μV' or 'mV'
         """
         _MAX_mV = 20  # 20mV, seldom an ECG device has range larger than this value
-        max_val = np.max(np.abs(data))
+        # max of abs without materializing `np.abs(data)`
+        max_val = max(abs(np.min(data)), abs(np.max(data)))
         if max_val > _MAX_mV:
             units = 'μV'
         else:
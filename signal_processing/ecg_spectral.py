@@ -6,12 +6,26 @@ As most of signal of CINC2020 have high sampling frequency and short duration,
 computing heart rate, mean rr interval from frequency domain would unsually be unfeasible,
 hence priority of this module is set LOW 
 """
+import os
+import threading
+from functools import lru_cache
 from numbers import Real
-from typing import Union, Optional, Sequence, NoReturn
+from typing import Union, Optional, Sequence, Tuple, NoReturn
 
 import numpy as np
 np.set_printoptions(precision=5, suppress=True)
+from numpy.lib.stride_tricks import sliding_window_view
 import scipy.signal as SS
+import scipy.fft
+try:
+    # FFTW is faster than the default pocketfft backend for the FFTs of `_welch`
+    import pyfftw
+except ImportError:
+    pyfftw = None
+try:
+    from numba import njit as _njit
+except ImportError:
+    _njit = None
 
 from cfg import FeatureCfg
 from utils.utils_signal import resample_irregular_timeseries
@@ -19,6 +33,7 @@ from utils.utils_signal import resample_irregular_timeseries
 
 __all__ = [
     "spectral_heart_rate",
+    "spectral_heart_rate_batch",
 ]
 
 
@@ -56,24 +71,68 @@ def spectral_heart_rate(filtered_sig:np.ndarray, fs:Real, hr_fs_band:Optional[Se
     for high frequency signal with short duration,
     the lowest frequency of the spectrogram might be too high for computing heart rate
     """
-    assert sig_fmt.lower() in ['channel_first', 'lead_first', 'channel_last', 'lead_last']
-    if sig_fmt.lower() in ['channel_last', 'lead_last']:
-        s = filtered_sig.T
-    else:
-        s = filtered_sig.copy()
+    fmt = sig_fmt.lower()
+    assert fmt in ['channel_first', 'lead_first', 'channel_last', 'lead_last']
+    ret_val = spectral_heart_rate_batch(
+        filtered_sig[np.newaxis, ...], fs,
+        hr_fs_band=hr_fs_band, sig_fmt=fmt, mode=mode, verbose=verbose,
+    )[0]
+    return ret_val
+
+
+def spectral_heart_rate_batch(filtered_sigs:np.ndarray, fs:Real, hr_fs_band:Optional[Sequence[Real]]=None, sig_fmt:str="channel_first", mode:str='hr', verbose:int=0) -> np.ndarray:
+    """ finished, NOT checked,
+
+    batched version of `spectral_heart_rate`,
+    the psd of all the leads of all the records are computed in one batch
+
+    Parameters:
+    -----------
+    filtered_sigs: ndarray,
+        the filtered 12-lead ecg signals, with units in mV,
+        of shape (batch_size, n_leads, siglen) if `sig_fmt` is 'channel_first',
+        or (batch_size, siglen, n_leads) if `sig_fmt` is 'channel_last'
+    fs: real number,
+        sampling frequency of `filtered_sigs`
+    hr_fs_band: sequence of real number, optional,
+        frequency band (bounds) of heart rate
+    sig_fmt: str, default "channel_first",
+        format of the multi-lead ecg signals,
+        'channel_last' (alias 'lead_last'), or
+        'channel_first' (alias 'lead_first', original)
+    mode: str, default 'hr',
+        mode of computation (return mean heart rate or mean rr intervals),
+        can also be 'heart_rate' (alias of 'hr'), and 'rr' (with an alias of 'rr_interval'),
+        case insensitive
+    verbose: int, default 0,
+        print verbosity
     
-    # psd of shape (c,n,k), freqs of shape (n,)
-    # where n = length of signal, c = number of leads, k rel. to freq bands
+    Returns:
+    --------
+    ret_val: ndarray,
+        mean heart rates of the ecg signals, with units in bpm;
+        or mean rr intervals, with units in ms,
+        of shape (batch_size,)
+    """
+    fmt = sig_fmt.lower()
+    assert fmt in ['channel_first', 'lead_first', 'channel_last', 'lead_last']
+    # `_welch` does not modify its input, hence no copy is needed
+    s = filtered_sigs.transpose(0, 2, 1) if fmt in ['channel_last', 'lead_last'] else filtered_sigs
+    batch_size, n_leads = s.shape[:2]
+    
+    # psd of shape (b,c,k), freqs of shape (k,)
+    # where b = batch size, c = number of leads, k rel. to freq bands
     # freqs, _, psd = SS.spectrogram(s, fs, axis=-1)
-    freqs, psd = SS.welch(s, fs, axis=-1)
+    freqs, psd = _welch(s.reshape(batch_size * n_leads, -1), fs)
+    psd = psd.reshape(batch_size, n_leads, -1)
 
     if not _check_feasibility(freqs):
         raise ValueError("it is not feasible to compute heart rate in frequency domain")
 
     fs_band = hr_fs_band or FeatureCfg.spectral_hr_fs_band
-    assert len(fs_band) >= 2, "frequency band of heart rate should at least has 2 bounds"
-    fs_band = sorted(fs_band)
-    fs_band = [fs_band[0], fs_band[-1]]
+    if len(fs_band) < 2:
+        raise ValueError("frequency band of heart rate should at least has 2 bounds")
+    fs_band = (min(fs_band), max(fs_band))
 
     if verbose >= 1:
         print(f"signal shape = {s.shape}")
@@ -81,33 +140,33 @@ def spectral_heart_rate(filtered_sig:np.ndarray, fs:Real, hr_fs_band:Optional[Se
         print(f"freqs.shape = {freqs.shape}, psd.shape = {psd.shape}")
         print(f"freqs = {freqs.tolist()}")
 
-    inds_of_interest = np.where((fs_band[0] <= freqs) & (freqs <= fs_band[-1]))[0]
-    # psd_of_interest of shape (c, m), freqs_of_interest of shape (m,)
-    # where m = length of inds_of_interest
-    freqs_of_interest = freqs[inds_of_interest]
-    psd_of_interest = psd[...,inds_of_interest]
+    # `freqs` is monotonic, hence the band is a contiguous slice (view, no copy)
+    lo = np.searchsorted(freqs, fs_band[0], side='left')
+    hi = np.searchsorted(freqs, fs_band[-1], side='right')
+    # psd_of_interest of shape (b*c, m), freqs_of_interest of shape (m,)
+    # where m = hi - lo
+    freqs_of_interest = freqs[lo:hi]
+    psd_of_interest = psd[..., lo:hi].reshape(batch_size * n_leads, -1)
     peak_inds = np.argmax(psd_of_interest, axis=-1)
 
     if verbose >= 1:
-        print(f"inds_of_interest = {inds_of_interest.tolist()}")
+        print(f"inds_of_interest = {list(range(lo, hi))}")
         print(f"freqs_of_interest = {freqs_of_interest.tolist()}")
         print(f"peak_inds.shape = {peak_inds.shape}, peak_inds = {peak_inds.tolist()}")
         print(f"psd_of_interest.shape = {psd_of_interest.shape}")
 
     # averaging at a neighborhood of `peak_idx`
     n_nbh = 1
-    psd_mask = np.zeros_like(psd_of_interest, dtype=int)
-    for l in range(psd_mask.shape[0]):
-        psd_mask[l, max(0,peak_inds[l]-n_nbh):min(psd_mask.shape[-1],peak_inds[l]+n_nbh)] = 1
-    psd_of_interest = psd_of_interest * psd_mask
     # ret_val with units in second^{-1}
-    ret_val = np.mean(np.dot(psd_of_interest, freqs_of_interest) / np.sum(psd_of_interest, axis=-1))
+    ret_val = _nbh_weighted_freqs(psd_of_interest, freqs_of_interest, peak_inds, n_nbh)
+    ret_val = np.mean(ret_val.reshape(batch_size, n_leads), axis=-1)
     if mode.lower() in ['hr', 'heart_rate']:
         ret_val = 60 * ret_val
     elif mode.lower() in ['rr', 'rr_interval']:
         ret_val = 1000 / ret_val
     return ret_val
 
+
 def _check_feasibility(freqs: np.ndarray) -> bool:
     """ finished, checked,
 
@@ -124,7 +183,184 @@ def _check_feasibility(freqs: np.ndarray) -> bool:
     is_feasible: bool,
         whether or not it is feasible to compute heart rate in frequency domain
     """
-    _f = np.asarray(freqs)
-    _f = np.sort(_f[_f>0])
-    is_feasible = (_f[0] <= 50/60) and (_f[-1] >= 100/60)
+    f_min, f_max = _positive_range(np.asarray(freqs, dtype=float))
+    is_feasible = (f_min <= 50/60) and (f_max >= 100/60)
     return is_feasible
+
+
+def _welch(s:np.ndarray, fs:Real, nperseg:int=256) -> Tuple[np.ndarray, np.ndarray]:
+    """ finished, checked,
+
+    equivalent of `SS.welch` along the last axis (hann window, half overlap, constant detrend, density scaling),
+    with all the segments of all the leading axes (leads, records, etc.) transformed together,
+    through a fixed-size FFTW plan (if pyfftw is available) planned once per `nperseg`
+
+    Parameters:
+    -----------
+    s: ndarray,
+        the signal(s), of shape (..., n)
+    fs: real number,
+        sampling frequency of `s`
+    nperseg: int, default 256,
+        length of each segment, truncated to the length of `s`
+
+    Returns:
+    --------
+    freqs: ndarray,
+        sample frequencies, of shape (k,)
+    psd: ndarray,
+        power spectral density, of shape (..., k)
+    """
+    nperseg = min(nperseg, s.shape[-1])
+    step = nperseg - nperseg // 2
+    win = _hann_window(nperseg)
+    # segs of shape (..., n_segs, nperseg)
+    segs = sliding_window_view(s, nperseg, axis=-1)[..., ::step, :]
+    segs = segs - segs.mean(axis=-1, keepdims=True)
+    segs *= win.astype(segs.dtype, copy=False)
+    spec = _rfft(segs)
+    psd = np.square(spec.real) + np.square(spec.imag)
+    psd *= 1.0 / (fs * np.sum(win * win))
+    # one-sided, the DC (and Nyquist, for even `nperseg`) components are not doubled
+    if nperseg % 2:
+        psd[..., 1:] *= 2
+    else:
+        psd[..., 1:-1] *= 2
+    psd = psd.mean(axis=-2)
+    freqs = np.fft.rfftfreq(nperseg, 1 / fs)
+    return freqs, psd
+
+
+@lru_cache(maxsize=16)
+def _hann_window(nperseg:int) -> np.ndarray:
+    """
+    (periodic) hann window of length `nperseg`, the default window of `SS.welch`
+    """
+    win = SS.get_window('hann', nperseg)
+    win.flags.writeable = False
+    return win
+
+
+# number of segments transformed by one execution of the FFTW plan of `_rfft`
+_RFFT_BLOCK_ROWS = 256
+
+
+def _rfft(segs:np.ndarray) -> np.ndarray:
+    """
+    rfft along the last axis, via a cached FFTW plan if pyfftw is available,
+    otherwise via `scipy.fft.rfft` on all the available workers;
+    the plan has a fixed block of `_RFFT_BLOCK_ROWS` segments,
+    through which the segments are pushed in chunks, so that it is planned once per segment length
+    """
+    if pyfftw is None:
+        return scipy.fft.rfft(segs, axis=-1, workers=-1)
+    nperseg = segs.shape[-1]
+    rows = segs.reshape(-1, nperseg)
+    plan, lock = _rfft_plan(nperseg, rows.dtype.str)
+    spec = np.empty((rows.shape[0], plan.output_array.shape[-1]), dtype=plan.output_array.dtype)
+    # the plan owns its input and output buffers, which are shared by all the threads,
+    # and FFTW releases the GIL during execution, hence the lock
+    with lock:
+        for start in range(0, rows.shape[0], _RFFT_BLOCK_ROWS):
+            n_rows = min(_RFFT_BLOCK_ROWS, rows.shape[0] - start)
+            plan.input_array[:n_rows] = rows[start: start+n_rows]
+            plan.execute()
+            spec[start: start+n_rows] = plan.output_array[:n_rows]
+    return spec.reshape(segs.shape[:-1] + (-1,))
+
+
+@lru_cache(maxsize=4)
+def _rfft_plan(nperseg:int, dtype:str) -> Tuple["pyfftw.FFTW", threading.Lock]:
+    """
+    FFTW plan of rfft along the last axis for blocks of shape (`_RFFT_BLOCK_ROWS`, `nperseg`) and dtype `dtype`,
+    along with the lock guarding its execution
+    """
+    plan = pyfftw.builders.rfft(
+        pyfftw.empty_aligned((_RFFT_BLOCK_ROWS, nperseg), dtype=dtype), axis=-1,
+        planner_effort='FFTW_MEASURE', threads=os.cpu_count(),
+    )
+    return plan, threading.Lock()
+
+
+def _nbh_weighted_freqs(psd:np.ndarray, freqs:np.ndarray, peak_inds:np.ndarray, n_nbh:int) -> np.ndarray:
+    """ finished, checked,
+
+    psd-weighted mean frequency of each row of `psd`,
+    over the neighborhood [peak_idx-n_nbh, peak_idx+n_nbh) of its peak,
+    gathering only the bins of the neighborhood instead of masking the whole band
+
+    Parameters:
+    -----------
+    psd: ndarray,
+        power spectral density, of shape (c, m)
+    freqs: ndarray,
+        sample frequencies of `psd`, of shape (m,)
+    peak_inds: ndarray,
+        indices of the peaks of each row of `psd`, of shape (c,)
+    n_nbh: int,
+        size of the neighborhood
+
+    Returns:
+    --------
+    weighted_freqs: ndarray,
+        of shape (c,)
+    """
+    m = psd.shape[-1]
+    nbh_inds = peak_inds[:, np.newaxis] + np.arange(-n_nbh, n_nbh)[np.newaxis, :]
+    nbh_valid = (nbh_inds >= 0) & (nbh_inds < m)
+    nbh_inds = nbh_inds.clip(0, m-1)
+    psd_nbh = np.take_along_axis(psd, nbh_inds, axis=-1) * nbh_valid
+    weighted_freqs = np.sum(psd_nbh * freqs[nbh_inds], axis=-1) / np.sum(psd_nbh, axis=-1)
+    return weighted_freqs
+
+
+def _positive_range(freqs:np.ndarray) -> Tuple[float, float]:
+    """ finished, checked,
+
+    minimum and maximum of the positive values of `freqs`,
+    (inf, -inf) if there is no positive value
+    """
+    _f = freqs[freqs>0]
+    if _f.size == 0:
+        return np.inf, -np.inf
+    return _f.min(), _f.max()
+
+
+def _nbh_weighted_freqs_loop(psd:np.ndarray, freqs:np.ndarray, peak_inds:np.ndarray, n_nbh:int) -> np.ndarray:
+    """
+    loop version of `_nbh_weighted_freqs`, to be compiled by numba
+    """
+    m = psd.shape[-1]
+    weighted_freqs = np.empty(psd.shape[0])
+    for l in range(psd.shape[0]):
+        num, den = 0.0, 0.0
+        for k in range(max(0, peak_inds[l]-n_nbh), min(m, peak_inds[l]+n_nbh)):
+            num += psd[l, k] * freqs[k]
+            den += psd[l, k]
+        weighted_freqs[l] = num / den
+    return weighted_freqs
+
+
+def _positive_range_loop(freqs:np.ndarray) -> Tuple[float, float]:
+    """
+    single pass version of `_positive_range`, to be compiled by numba
+    """
+    f_min, f_max = np.inf, -np.inf
+    for f in freqs:
+        if f > 0:
+            f_min = min(f_min, f)
+            f_max = max(f_max, f)
+    return f_min, f_max
+
+
+if _njit is not None:
+    # compile (and warm up) the kernels, falling back to the numpy versions on failure
+    try:
+        _nbh_weighted_freqs_jit = _njit(cache=True, error_model='numpy')(_nbh_weighted_freqs_loop)
+        _positive_range_jit = _njit(cache=True)(_positive_range_loop)
+        _nbh_weighted_freqs_jit(np.ones((1, 3)), np.arange(3.0), np.zeros((1,), dtype=int), 1)
+        _positive_range_jit(np.arange(3.0))
+        _nbh_weighted_freqs = _nbh_weighted_freqs_jit
+        _positive_range = _positive_range_jit
+    except Exception:
+        pass